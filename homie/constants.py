@@ -5,12 +5,15 @@ QOS = const(1)
 MAIN_DELAY = const(1000)
 STATS_DELAY = const(60000)
 WDT_DELAY = const(100)
+RESTORE_DELAY = const(250)
+MAX_CONCURRENT = const(2)
 DEVICE_STATE = b"$state"
 
 # Device states
 STATE_INIT = b"init"
 STATE_READY = b"ready"
 STATE_RECOVER = b"recover"
+STATE_DISCONNECTED = b"disconnected"
 
 # Property datatypes
 STRING = b"string"
@@ -26,6 +29,7 @@ HSV = b"hsv"
 
 # Node
 PUBLISH_DELAY = const(20)
+PUBLISH_QUEUE_LEN = const(16)
 
 # (Sub)Tobics
 T_BC = b"/$broadcast"
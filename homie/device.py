@@ -1,17 +1,22 @@
-from gc import collect, mem_free
+from gc import collect, mem_free, threshold
 from sys import platform
 
-from asyn import Event, launch
+from asyn import launch
 from homie import __version__, utils
 from homie.constants import (
     DEVICE_STATE,
     MAIN_DELAY,
+    MAX_CONCURRENT,
+    PUBLISH_DELAY,
+    PUBLISH_QUEUE_LEN,
     QOS,
+    RESTORE_DELAY,
+    SET,
     SLASH,
+    STATE_DISCONNECTED,
     STATE_INIT,
     STATE_READY,
     STATE_RECOVER,
-    T_BC,
     T_SET,
     UNDERSCORE,
     UTF8,
@@ -22,16 +27,50 @@ from uasyncio import get_event_loop, sleep_ms
 from ubinascii import hexlify
 from utime import time
 
-_EVENT = Event()
+# Optional device settings: attribute name, settings name, default
+_DEVICE_SETTINGS = (
+    ("debug", "DEBUG", False),
+    ("_extensions", "EXTENSIONS", ()),
+    ("stats_interval", "DEVICE_STATS_INTERVAL", 60),
+    ("device_name", "DEVICE_NAME", b"mydevice"),
+    ("btopic", "MQTT_BASE_TOPIC", b"homie"),
+)
+
+# Optional MQTT settings: MQTTClient keyword, settings name, default
+_MQTT_SETTINGS = (
+    ("port", "MQTT_PORT", 1883),
+    ("user", "MQTT_USERNAME", None),
+    ("password", "MQTT_PASSWORD", None),
+    ("keepalive", "MQTT_KEEPALIVE", 30),
+    ("ping_interval", "MQTT_PING_INTERVAL", 0),
+    ("ssl", "MQTT_SSL", False),
+    ("ssl_params", "MQTT_SSL_PARAMS", None),
+    ("response_time", "MQTT_RESPONSE_TIME", 10),
+    ("clean_init", "MQTT_CLEAN_INIT", True),
+    ("clean", "MQTT_CLEAN", True),
+    ("max_repubs", "MQTT_MAX_REPUBS", 4),
+    ("ssid", "WIFI_SSID", None),
+    ("wifi_pw", "WIFI_PASSWORD", None),
+)
+
+
+def _to_bytes(payload):
+    """convert a non bytes payload to bytes"""
+    t = type(payload)
+    if t is int:
+        # no intermediate str object
+        return b"%d" % payload
+    if t is str:
+        return payload.encode()
+    return bytes(str(payload), UTF8)
 
 
 # Decorator to block async coros until the device is in "ready" state
 def await_ready_state(func):
-    def new_gen(*args, **kwargs):
-        # fmt: off
-        await _EVENT
+    async def new_gen(*args, **kwargs):
+        while not HomieDevice._ready:
+            await sleep_ms(MAIN_DELAY)
         await func(*args, **kwargs)
-        # fmt: on
 
     return new_gen
 
@@ -40,18 +79,34 @@ class HomieDevice:
 
     """MicroPython implementation of the Homie MQTT convention for IoT."""
 
+    # set once the device published all topics on the first connection
+    _ready = False
+
     def __init__(self, settings):
-        self.debug = getattr(settings, "DEBUG", False)
+        # Create the event loop before anything else does. The fast_io
+        # fork of uasyncio schedules pending I/O before the run queue if
+        # ioq_len is set, the official uasyncio has no such option.
+        try:
+            get_event_loop(runq_len=16, waitq_len=16, ioq_len=4)
+        except TypeError:
+            get_event_loop()
+
+        for attr, name, default in _DEVICE_SETTINGS:
+            setattr(self, attr, getattr(settings, name, default))
+
         self._state = STATE_INIT
-        self._extensions = getattr(settings, "EXTENSIONS", [])
+        self._extensions_blob = b",".join(self._extensions)
         self._first_start = True
-
-        self.stats_interval = getattr(settings, "DEVICE_STATS_INTERVAL", 60)
+        self._shutdown = False
 
         self.nodes = []
+        self.async_tasks = []
+        self._nodes_blob = b""
         self.callback_topics = {}
-
-        self.device_name = getattr(settings, "DEVICE_NAME", b"mydevice")
+        self._topic_cache = {}
+        # publish queue of (topic, payload, retain) tuples
+        self._pubq = []
+        self._publishing = False
 
         # Generate unique id if settings has no DEVICE_ID
         try:
@@ -59,39 +114,78 @@ class HomieDevice:
         except AttributeError:
             device_id = utils.get_unique_id()
 
-        # Base topic
-        self.btopic = getattr(settings, "MQTT_BASE_TOPIC", b"homie")
         # Device base topic
         self.dtopic = SLASH.join((self.btopic, device_id))
-
-        self.mqtt = MQTTClient(
+        # Prefix of all node topics and index of the node id in a splitted
+        # device topic
+        self._node_prefix = self.dtopic + SLASH
+        self._node_idx = len(self.dtopic.split(SLASH))
+        # Broadcast topic
+        self._broadcast_topic = SLASH.join((self.btopic, b"$broadcast"))
+        self._broadcast_levels = {}
+
+        # The MQTT client gets created in run()
+        self.mqtt = None
+        self._mqtt_kwargs = {
+            kw: getattr(settings, name, default)
+            for kw, name, default in _MQTT_SETTINGS
+        }
+        # every device gets its own ssl params dict
+        if self._mqtt_kwargs["ssl_params"] is None:
+            self._mqtt_kwargs["ssl_params"] = {}
+        self._mqtt_kwargs.update(
             client_id=device_id,
             server=settings.MQTT_BROKER,
-            port=getattr(settings, "MQTT_PORT", 1883),
-            user=getattr(settings, "MQTT_USERNAME", None),
-            password=getattr(settings, "MQTT_PASSWORD", None),
-            keepalive=getattr(settings, "MQTT_KEEPALIVE", 30),
-            ping_interval=getattr(settings, "MQTT_PING_INTERVAL", 0),
-            ssl=getattr(settings, "MQTT_SSL", False),
-            ssl_params=getattr(settings, "MQTT_SSL_PARAMS", {}),
-            response_time=getattr(settings, "MQTT_RESPONSE_TIME", 10),
-            clean_init=getattr(settings, "MQTT_CLEAN_INIT", True),
-            clean=getattr(settings, "MQTT_CLEAN", True),
-            max_repubs=getattr(settings, "MQTT_MAX_REPUBS", 4),
             will=(SLASH.join((self.dtopic, DEVICE_STATE)), b"lost", True, QOS),
             subs_cb=self.sub_cb,
             wifi_coro=None,
             connect_coro=self.connection_handler,
-            ssid=getattr(settings, "WIFI_SSID", None),
-            wifi_pw=getattr(settings, "WIFI_PASSWORD", None),
         )
 
+        # Run the garbage collection after a fixed amount of allocations
+        try:
+            gc_threshold = settings.GC_THRESHOLD
+        except AttributeError:
+            gc_threshold = mem_free() // 4
+        threshold(gc_threshold)
+
     def add_node(self, node):
         """add a node class of Homie Node to this device"""
-        collect()
         node.device = self
         self.nodes.append(node)
-        launch(node.publish_data, ())
+
+        # encode the node id once and precompute the full property topics
+        nid = node.id
+        nid_b = node._id_b = nid.encode()
+        self.callback_topics[nid_b] = node.callback
+        topic = self.property_topic
+        for pid, p in node._properties.items():
+            topic(nid, pid)
+            if p.settable:
+                topic(nid, pid, SET)
+
+        self._nodes_blob = b",".join([n._id_b for n in self.nodes])
+
+        if self.mqtt is None:
+            # the task gets created in run()
+            self.async_tasks.append(node.publish_data)
+        else:
+            # run() already started the node tasks
+            launch(node.publish_data, ())
+
+    def property_topic(self, nid, pid, sub=None):
+        """return the full topic of a node property or its sub topic"""
+        key = (nid, pid, sub)
+        try:
+            return self._topic_cache[key]
+        except KeyError:
+            pass
+
+        t = SLASH.join((self.dtopic, nid.encode(), pid.encode()))
+        if sub is not None:
+            t = SLASH.join((t, sub))
+        self._topic_cache[key] = t
+        return t
 
     def format_topic(self, topic):
         if self.dtopic in topic:
@@ -101,47 +195,52 @@ class HomieDevice:
     async def subscribe(self, topic):
         topic = self.format_topic(topic)
         self.dprint("MQTT SUBSCRIBE: {}".format(topic))
+        # the MQTT client gets created in run()
+        while self.mqtt is None:
+            await sleep_ms(MAIN_DELAY)
         await self.mqtt.subscribe(topic, QOS)
 
     async def unsubscribe(self, topic):
         topic = self.format_topic(topic)
         self.dprint("MQTT UNSUBSCRIBE: {}".format(topic))
+        # the MQTT client gets created in run()
+        while self.mqtt is None:
+            await sleep_ms(MAIN_DELAY)
         await self.mqtt.unsubscribe(topic)
 
-    async def add_node_cb(self, node):
-        # Add the node callback method only once to the callback list
-        nid = node.id.encode()
-        if nid not in self.callback_topics:
-            self.callback_topics[nid] = node.callback
-
     async def connection_handler(self, client):
         """subscribe to all registered device and node topics"""
-        if self._first_start is False:
+        if self._first_start is True:
+            # start the consumer of the publish queue
+            launch(self.publisher, ())
+        else:
             await self.publish(DEVICE_STATE, STATE_RECOVER)
 
-        retained = []
         subscribe = self.subscribe
         unsubscribe = self.unsubscribe
 
         await self.mqtt.subscribe(
-            SLASH.join((self.btopic, b"$broadcast/#")), QOS
+            SLASH.join((self._broadcast_topic, b"#")), QOS
         )
 
         # node topics
+        topic = self.property_topic
+        retained = []
+        topics = []
         nodes = self.nodes
         for n in nodes:
+            nid = n.id
             props = n._properties
             for pid, p in props.items():
                 if p.restore:
                     # Restore from topic with retained message
-                    await self.add_node_cb(n)
-                    t = b"{}/{}".format(n.id, pid)
-                    await subscribe(t)
-                    retained.append(t)
+                    retained.append(topic(nid, pid))
 
                 if p.settable:
-                    await self.add_node_cb(n)
-                    await subscribe(b"{}/{}/set".format(n.id, pid))
+                    topics.append(topic(nid, pid, SET))
+
+        topics.extend(retained)
+        await self.gather([subscribe(t) for t in topics])
 
         # on first connection:
         # * publish device and node properties
@@ -149,10 +248,14 @@ class HomieDevice:
         # * run all coros
         if self._first_start is True:
             await self.publish_properties()
+            collect()
+
+            # publish only queues the messages, give the broker some time
+            # to deliver the retained messages of the restore topics
+            await sleep_ms(RESTORE_DELAY)
 
             # unsubscribe from retained topic (restore)
-            for t in retained:
-                await unsubscribe(t)
+            await self.gather([unsubscribe(t) for t in retained])
 
             self._first_start = False
 
@@ -161,9 +264,7 @@ class HomieDevice:
                 launch(self.wdt, ())
 
             # start coros waiting for ready state
-            _EVENT.set()
-            await sleep_ms(MAIN_DELAY)
-            _EVENT.clear()
+            HomieDevice._ready = True
 
         await self.publish(DEVICE_STATE, STATE_READY)
 
@@ -177,37 +278,96 @@ class HomieDevice:
             return
 
         # broadcast callback passed to nodes
-        if T_BC in topic:
+        if topic.startswith(self._broadcast_topic):
             nodes = self.nodes
             for n in nodes:
                 n.broadcast_callback(topic, payload, retained)
-        else:
+        elif topic.startswith(self._node_prefix):
             # node property callbacks
-            nt = topic.split(SLASH)
-            node = nt[len(self.dtopic.split(SLASH))]
+            idx = self._node_idx
+            node = topic.split(SLASH, idx + 1)[idx]
             if node in self.callback_topics:
                 self.callback_topics[node](topic, payload, retained)
 
     async def publish(self, topic, payload, retain=True):
-        if not isinstance(payload, bytes):
-            payload = bytes(str(payload), UTF8)
+        if type(payload) is not bytes:
+            payload = _to_bytes(payload)
 
-        t = SLASH.join((self.dtopic, topic))
+        # cached property topics already contain the device topic
+        t = self.format_topic(topic)
         self.dprint("MQTT PUBLISH: {} --> {}".format(t, payload))
-        await self.mqtt.publish(t, payload, retain, QOS)
+
+        # wait for the publisher if the queue is full
+        queue = self._pubq
+        while len(queue) >= PUBLISH_QUEUE_LEN:
+            await sleep_ms(PUBLISH_DELAY)
+
+        if retain:
+            # only the newest payload of a retained topic gets published,
+            # at the position of the newest message
+            for i, m in enumerate(queue):
+                if m[0] == t and m[2]:
+                    del queue[i]
+                    break
+        queue.append((t, payload, retain))
+
+    async def publisher(self):
+        """publish the messages from the publish queue in order"""
+        queue = self._pubq
+        mqtt = self.mqtt
+        while True:
+            if queue:
+                t, payload, retain = queue.pop(0)
+                self._publishing = True
+                try:
+                    await mqtt.publish(t, payload, retain, QOS)
+                finally:
+                    self._publishing = False
+            else:
+                await sleep_ms(PUBLISH_DELAY)
 
     async def broadcast(self, payload, level=None):
-        if not isinstance(payload, bytes):
-            payload = bytes(str(payload), UTF8)
-
-        topic = SLASH.join((self.btopic, b"$broadcast"))
-        if level is not None:
-            if isinstance(level, str):
-                level = level.encode()
-            topic = SLASH.join((topic, level))
+        if type(payload) is not bytes:
+            payload = _to_bytes(payload)
+
+        if level is None:
+            topic = self._broadcast_topic
+        else:
+            topic = self._broadcast_levels.get(level)
+            if topic is None:
+                if isinstance(level, str):
+                    lvl = level.encode()
+                else:
+                    lvl = level
+                topic = SLASH.join((self._broadcast_topic, lvl))
+                self._broadcast_levels[level] = topic
         self.dprint("MQTT BROADCAST: {} --> {}".format(topic, payload))
+        # the MQTT client gets created in run()
+        while self.mqtt is None:
+            await sleep_ms(MAIN_DELAY)
         await self.mqtt.publish(topic, payload, retain=False, qos=QOS)
 
+    async def gather(self, coros):
+        """run coros concurrently, MAX_CONCURRENT at a time"""
+        loop = get_event_loop()
+        running = [0]
+
+        async def wrap(coro):
+            try:
+                await coro
+            finally:
+                running[0] -= 1
+
+        for coro in coros:
+            while running[0] >= MAX_CONCURRENT:
+                await sleep_ms(PUBLISH_DELAY)
+            running[0] += 1
+            loop.create_task(wrap(coro))
+
+        # sleep instead of yielding while the last coros are running
+        while running[0]:
+            await sleep_ms(PUBLISH_DELAY)
+
     async def publish_properties(self):
         """publish device and node properties"""
         publish = self.publish
@@ -217,9 +377,7 @@ class HomieDevice:
         await publish(b"$name", self.device_name)
         await publish(DEVICE_STATE, STATE_INIT)
         await publish(b"$implementation", bytes(platform, UTF8))
-        await publish(
-            b"$nodes", b",".join([n.id.encode() for n in self.nodes])
-        )
+        await publish(b"$nodes", self._nodes_blob)
 
         # node properties
         nodes = self.nodes
@@ -227,7 +385,7 @@ class HomieDevice:
             await n.publish_properties()
 
         if self._extensions:
-            await publish(b"$extensions", b",".join(self._extensions))
+            await publish(b"$extensions", self._extensions_blob)
             if b"org.homie.legacy-firmware:0.1.1:[4.x]" in self._extensions:
                 await publish(b"$localip", utils.get_local_ip())
                 await publish(b"$mac", utils.get_local_mac())
@@ -235,36 +393,72 @@ class HomieDevice:
                 await publish(b"$fw/version", __version__)
             if b"org.homie.legacy-stats:0.1.1:[4.x]" in self._extensions:
                 await self.publish(b"$stats/interval", self.stats_interval)
+                # Full stats topics, published every interval
+                dtopic = self.dtopic
+                self._topic_uptime = SLASH.join((dtopic, b"$stats/uptime"))
+                self._topic_freeheap = SLASH.join((dtopic, b"$stats/freeheap"))
                 # Start stats coro
                 launch(self.publish_stats, ())
 
-    @await_ready_state
     async def publish_stats(self):
-        from utime import time
+        while not self._ready:
+            await sleep_ms(MAIN_DELAY)
 
         start_time = time()
         delay = self.stats_interval * MAIN_DELAY
         publish = self.publish
+        t_uptime = self._topic_uptime
+        t_freeheap = self._topic_freeheap
         while True:
             uptime = time() - start_time
-            await publish(b"$stats/uptime", uptime)
-            await publish(b"$stats/freeheap", mem_free())
+            await publish(t_uptime, uptime)
+            await publish(t_freeheap, mem_free())
             await sleep_ms(delay)
 
     async def run(self):
+        # create the MQTT client and start the node coros after all setup
+        # allocations are collected
+        if self.mqtt is None:
+            self.mqtt = MQTTClient(**self._mqtt_kwargs)
+            self._mqtt_kwargs = None
+
+        loop = get_event_loop()
+        tasks = self.async_tasks
+        for coro in tasks:
+            loop.create_task(coro())
+        del tasks[:]
+        collect()
+
         while True:
             try:
                 await self.mqtt.connect()
-                while True:
-                    await sleep_ms(MAIN_DELAY)
+                break
             except OSError:
                 print("ERROR: can not connect to MQTT")
                 await sleep_ms(5000)
 
+        # mqtt_as keeps the connection alive, there is nothing left to do.
+        # Sleep long, stop() ends the event loop without waiting for us.
+        while not self._shutdown:
+            await sleep_ms(3600000)
+
     def run_forever(self):
         loop = get_event_loop()
         loop.run_until_complete(self.run())
 
+    async def stop(self):
+        """disconnect from the broker and stop the main loop"""
+        if self._first_start is False:
+            # queue the state after all pending messages and wait until the
+            # publisher has sent them all
+            await self.publish(DEVICE_STATE, STATE_DISCONNECTED)
+            while self._pubq or self._publishing:
+                await sleep_ms(PUBLISH_DELAY)
+        if self.mqtt is not None:
+            await self.mqtt.disconnect()
+        self._shutdown = True
+        get_event_loop().stop()
+
     async def wdt(self):
         from machine import WDT
 
@@ -52,6 +52,7 @@ class HomieNode:
     async def publish_data(self):
         nid = self.id
         props = self._properties
+        topic = self.device.property_topic
         publish = self.device.publish
 
         while True:
@@ -60,8 +61,7 @@ class HomieNode:
                     data = p._data
                     p.update = False
                     if data is not None:
-                        t = b"{}/{}".format(nid, pid)
-                        await publish(t, data, p.retained)
+                        await publish(topic(nid, pid), data, p.retained)
 
             await sleep_ms(PUBLISH_DELAY)
 
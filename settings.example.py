@@ -1,6 +1,10 @@
 # Debug mode disables WDT
 # DEBUG = False
 
+# Run the garbage collection after this amount of bytes are allocated.
+# Default is a quarter of the free heap on device initialization.
+# GC_THRESHOLD = 8192
+
 ###
 # Wifi settings
 ###